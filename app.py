@@ -1,11 +1,18 @@
+import asyncio
 import base64
+import collections
 import datetime
+import hashlib
+import hmac
 import io
+import operator
 import os
 import tempfile
+import threading
 import time
 import uuid
-from typing import Any, Dict, List, Optional, Sequence, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
 
 import json
 
@@ -16,33 +23,57 @@ try:
 except ImportError:
     CookieController = None
 
+try:
+    import pybase64 as b64_codec
+except ImportError:
+    b64_codec = base64
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 try:
     from streamlit.runtime.secrets import StreamlitSecretNotFoundError
 except ImportError:
     StreamlitSecretNotFoundError = Exception
 
 try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:
+    add_script_run_ctx = None
+    get_script_run_ctx = None
+
+if TYPE_CHECKING:
     from google import genai
-    from google.api_core import exceptions as google_exceptions
     from google.genai import types
-    from google.cloud import storage
-except ImportError:
-    st.error(
-        "必要なライブラリが不足しています。`pip install -r requirements.txt` を実行してください。"
-    )
-    st.stop()
 
-def get_secret_value(key: str) -> Optional[str]:
+
+def require_generation_libraries() -> None:
     try:
-        secrets_obj = st.secrets
-    except StreamlitSecretNotFoundError:
-        return None
-    except Exception:
+        import httpx  # noqa: F401
+        from google import genai  # noqa: F401
+        from google.api_core import exceptions  # noqa: F401
+    except ImportError:
+        st.error(
+            "必要なライブラリが不足しています。`pip install -r requirements.txt` を実行してください。"
+        )
+        st.stop()
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _read_secret(key: str) -> Optional[str]:
+    secrets_obj = getattr(st, "secrets", None)
+    if secrets_obj is None:
         return None
     try:
+        if key not in secrets_obj:
+            return None
         return secrets_obj[key]
-    except (KeyError, TypeError, StreamlitSecretNotFoundError):
+    except TypeError:
         pass
+    except Exception:
+        return None
     get_method = getattr(secrets_obj, "get", None)
     if callable(get_method):
         try:
@@ -52,6 +83,10 @@ def get_secret_value(key: str) -> Optional[str]:
     return None
 
 
+def get_secret_value(key: str) -> Optional[str]:
+    return _read_secret(key)
+
+
 def rerun_app() -> None:
     rerun = getattr(st, "rerun", None)
     if callable(rerun):
@@ -65,9 +100,18 @@ def rerun_app() -> None:
 TITLE = "Gemini 画像生成"
 MODEL_NAME = "models/gemini-2.5-flash-image"
 IMAGE_ASPECT_RATIO = "16:9"
+GENERATE_TIMEOUT_SECONDS = 60
+GENERATE_RETRY_ATTEMPTS = 2
+RATE_LIMIT_WAIT_SECONDS = 10
+MAX_VARIATIONS = 4
 COOKIE_KEY = "logged_in"
 SESSION_COOKIE_KEY = "browser_session_id"
 HISTORY_DIR = os.path.join(tempfile.gettempdir(), "nanobanana_history")
+HISTORY_IMAGE_DIR = os.path.join(HISTORY_DIR, "images")
+HISTORY_MAX_ENTRIES = 20
+HISTORY_LOG_COMPACT_LINES = HISTORY_MAX_ENTRIES * 2
+THUMBNAIL_MAX_SIZE = (768, 768)
+THUMBNAIL_QUALITY = 85
 DEFAULT_PROMPT_SUFFIX = (
     "((masterpiece, best quality, ultra-detailed, photorealistic, 8k, sharp focus))"
 )
@@ -75,13 +119,7 @@ NO_TEXT_TOGGLE_SUFFIX = (
     "((no background text, no symbols, no markings, no letters anywhere, no typography, "
     "no signboard, no watermark, no logo, no text, no subtitles, no labels, no poster elements, neutral background))"
 )
-
-DEFAULT_GEMINI_API_KEY = (
-    get_secret_value("GEMINI_API_KEY")
-    or os.getenv("GOOGLE_API_KEY")
-    or os.getenv("GEMINI_API_KEY")
-    or ""
-)
+PROMPT_WITH_NOTEXT_SUFFIX = f"{DEFAULT_PROMPT_SUFFIX}\n{NO_TEXT_TOGGLE_SUFFIX}"
 
 
 def _normalize_credential(value: Optional[str]) -> Optional[str]:
@@ -92,6 +130,14 @@ def _normalize_credential(value: Optional[str]) -> Optional[str]:
     return None
 
 
+def _hash_credential(value: Optional[str], key: bytes) -> bytes:
+    return hashlib.blake2b((value or "").encode("utf-8"), key=key).digest()
+
+
+def _credentials_match(value: Optional[str], key: bytes, expected_hash: bytes) -> bool:
+    return hmac.compare_digest(_hash_credential(value, key), expected_hash)
+
+
 def get_secret_auth_credentials() -> Tuple[Optional[str], Optional[str]]:
     try:
         secrets_obj = st.secrets
@@ -153,6 +199,18 @@ def get_configured_auth_credentials() -> Tuple[str, str]:
     return "mezamashi", "mezamashi"
 
 
+def get_expected_credential_hashes() -> Optional[Tuple[bytes, bytes, bytes]]:
+    if "_auth_hash_cache" in st.session_state:
+        return st.session_state["_auth_hash_cache"]
+    username, password = get_configured_auth_credentials()
+    hashes = None
+    if username and password:
+        key = os.urandom(hashlib.blake2b.MAX_KEY_SIZE)
+        hashes = (key, _hash_credential(username, key), _hash_credential(password, key))
+    st.session_state["_auth_hash_cache"] = hashes
+    return hashes
+
+
 def _get_cookie_controller() -> Optional[object]:
     if CookieController is None:
         return None
@@ -166,14 +224,22 @@ def _get_cookie_controller() -> Optional[object]:
     return controller
 
 
+def _refresh_cookie_controller(controller: object, force: bool = False) -> None:
+    if not force and st.session_state.get("_cookies_refreshed"):
+        return
+    controller.refresh()
+    st.session_state["_cookies_refreshed"] = True
+
+
 def sync_cookie_controller() -> None:
+    st.session_state["_cookies_refreshed"] = False
     controller = _get_cookie_controller()
     if controller is None:
         return
     sync_stage = st.session_state.get("_cookies_sync_stage", 0)
     if sync_stage == 0:
         try:
-            controller.refresh()
+            _refresh_cookie_controller(controller)
         except Exception:
             return
         st.session_state["_cookies_sync_stage"] = 1
@@ -181,7 +247,7 @@ def sync_cookie_controller() -> None:
         return
     if sync_stage == 1:
         try:
-            controller.refresh()
+            _refresh_cookie_controller(controller)
         except Exception:
             return
         st.session_state["_cookies_sync_stage"] = 2
@@ -191,9 +257,9 @@ def restore_login_from_cookie() -> bool:
     controller = _get_cookie_controller()
     if controller is None:
         return False
-    for _ in range(2):
+    for attempt in range(2):
         try:
-            controller.refresh()
+            _refresh_cookie_controller(controller, force=attempt > 0)
             if controller.get(COOKIE_KEY) == "1":
                 return True
         except Exception:
@@ -222,12 +288,77 @@ def _get_history_path(session_id: str) -> str:
     return os.path.join(HISTORY_DIR, f"{safe_id}.json")
 
 
+def _get_history_log_path(session_id: str) -> str:
+    return f"{os.path.splitext(_get_history_path(session_id))[0]}.jsonl"
+
+
+def write_history_image(image_id: str, image_bytes: bytes, extension: str = "png") -> Optional[str]:
+    os.makedirs(HISTORY_IMAGE_DIR, exist_ok=True)
+    safe_id = "".join(ch for ch in image_id if ch.isalnum() or ch in {"-", "_"})
+    image_path = os.path.join(HISTORY_IMAGE_DIR, f"{safe_id}.{extension}")
+    try:
+        with open(image_path, "wb") as file_handle:
+            file_handle.write(image_bytes)
+    except Exception:
+        return None
+    return image_path
+
+
+def read_history_image(image_path: Optional[str]) -> Optional[bytes]:
+    if not image_path:
+        return None
+    try:
+        with open(image_path, "rb") as file_handle:
+            return file_handle.read()
+    except Exception:
+        return None
+
+
+def build_thumbnail(image_bytes: bytes) -> Optional[bytes]:
+    try:
+        from PIL import Image
+
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image.thumbnail(THUMBNAIL_MAX_SIZE)
+            thumbnail = image if image.mode == "RGB" else image.convert("RGB")
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY)
+    except Exception:
+        return None
+    return buffer.getvalue()
+
+
+def store_history_images(image_id: str, image_bytes: bytes) -> Tuple[Optional[str], Optional[str]]:
+    image_path = write_history_image(image_id, image_bytes)
+    if not image_path:
+        return None, None
+    thumbnail_bytes = build_thumbnail(image_bytes)
+    thumbnail_path = (
+        write_history_image(f"{image_id}_thumb", thumbnail_bytes, extension="jpg")
+        if thumbnail_bytes
+        else None
+    )
+    return image_path, thumbnail_path
+
+
+def remove_history_image(entry: Dict[str, object]) -> None:
+    for key in ("image_path", "thumbnail_path"):
+        image_path = entry.get(key)
+        if not isinstance(image_path, str):
+            continue
+        try:
+            if os.path.exists(image_path):
+                os.remove(image_path)
+        except Exception:
+            continue
+
+
 def get_browser_session_id(create: bool = True) -> Optional[str]:
     controller = _get_cookie_controller()
     if controller is None:
         return None
     try:
-        controller.refresh()
+        _refresh_cookie_controller(controller)
         session_id = controller.get(SESSION_COOKIE_KEY)
     except Exception:
         session_id = None
@@ -244,21 +375,44 @@ def get_browser_session_id(create: bool = True) -> Optional[str]:
     return new_id
 
 
-def _serialize_history(history: List[Dict[str, object]]) -> List[Dict[str, object]]:
+def _json_dumps(value: object) -> str:
+    if orjson is not None:
+        return orjson.dumps(value).decode("utf-8")
+    return json.dumps(value)
+
+
+def _json_loads(text: str) -> object:
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _history_file_name(image_path: object) -> Optional[str]:
+    if not isinstance(image_path, str) or not image_path:
+        return None
+    return os.path.basename(image_path)
+
+
+def _resolve_history_file(file_name: object) -> Optional[str]:
+    if not isinstance(file_name, str) or not file_name:
+        return None
+    image_path = os.path.join(HISTORY_IMAGE_DIR, os.path.basename(file_name))
+    if not os.path.exists(image_path):
+        return None
+    return image_path
+
+
+def _serialize_history(history: Sequence[Dict[str, object]]) -> List[Dict[str, object]]:
     serialized: List[Dict[str, object]] = []
     for entry in history:
-        image_bytes = entry.get("image_bytes")
-        if isinstance(image_bytes, (bytes, bytearray, memoryview)):
-            image_b64 = base64.b64encode(bytes(image_bytes)).decode("utf-8")
-        else:
-            image_b64 = None
         serialized.append(
             {
                 "id": entry.get("id"),
                 "prompt": entry.get("prompt"),
                 "model": entry.get("model"),
                 "no_text": entry.get("no_text"),
-                "image_b64": image_b64,
+                "image_file": _history_file_name(entry.get("image_path")),
+                "thumbnail_file": _history_file_name(entry.get("thumbnail_path")),
             }
         )
     return serialized
@@ -267,30 +421,41 @@ def _serialize_history(history: List[Dict[str, object]]) -> List[Dict[str, objec
 def _deserialize_history(payload: List[Dict[str, object]]) -> List[Dict[str, object]]:
     history: List[Dict[str, object]] = []
     for entry in payload:
-        image_b64 = entry.get("image_b64")
-        image_bytes = decode_image_data(image_b64) if image_b64 else None
+        image_id = entry.get("id")
+        if not isinstance(image_id, str):
+            image_id = f"img_{uuid.uuid4().hex}"
+        image_path = _resolve_history_file(entry.get("image_file"))
+        thumbnail_path = _resolve_history_file(entry.get("thumbnail_file"))
+        if image_path is None:
+            image_b64 = entry.get("image_b64")
+            image_bytes = decode_image_data(image_b64) if image_b64 else None
+            image_path, thumbnail_path = (
+                store_history_images(image_id, image_bytes) if image_bytes else (None, None)
+            )
+        elif thumbnail_path is None:
+            thumbnail_bytes = build_thumbnail(read_history_image(image_path) or b"")
+            if thumbnail_bytes:
+                thumbnail_path = write_history_image(f"{image_id}_thumb", thumbnail_bytes, extension="jpg")
         history.append(
             {
-                "id": entry.get("id"),
+                "id": image_id,
                 "prompt": entry.get("prompt"),
                 "model": entry.get("model"),
                 "no_text": entry.get("no_text"),
-                "image_bytes": image_bytes,
+                "image_path": image_path,
+                "thumbnail_path": thumbnail_path,
             }
         )
     return history
 
 
-def load_history_from_storage() -> Optional[List[Dict[str, object]]]:
-    session_id = get_browser_session_id(create=False)
-    if not session_id:
-        return None
+def _load_legacy_history(session_id: str) -> Optional[List[Dict[str, object]]]:
     history_path = _get_history_path(session_id)
     if not os.path.exists(history_path):
         return None
     try:
         with open(history_path, "r", encoding="utf-8") as file_handle:
-            payload = json.load(file_handle)
+            payload = _json_loads(file_handle.read())
     except Exception:
         return None
     if not isinstance(payload, dict):
@@ -298,42 +463,95 @@ def load_history_from_storage() -> Optional[List[Dict[str, object]]]:
     entries = payload.get("history")
     if not isinstance(entries, list):
         return None
+    st.session_state["_history_log_lines"] = None
     return _deserialize_history(entries)
 
 
+def load_history_from_storage() -> Optional[List[Dict[str, object]]]:
+    session_id = get_browser_session_id(create=False)
+    if not session_id:
+        return None
+    log_path = _get_history_log_path(session_id)
+    if not os.path.exists(log_path):
+        return _load_legacy_history(session_id)
+    entries: List[Dict[str, object]] = []
+    try:
+        with open(log_path, "r", encoding="utf-8") as file_handle:
+            for line in file_handle:
+                try:
+                    entry = _json_loads(line)
+                except ValueError:
+                    continue
+                if isinstance(entry, dict):
+                    entries.append(entry)
+    except Exception:
+        return None
+    st.session_state["_history_log_lines"] = len(entries)
+    return _deserialize_history(entries[::-1][:HISTORY_MAX_ENTRIES])
+
+
 def persist_history_to_storage() -> None:
     session_id = get_browser_session_id(create=True)
     if not session_id:
         return
+    serialized = _serialize_history(st.session_state.history)
+    try:
+        with open(_get_history_log_path(session_id), "w", encoding="utf-8") as file_handle:
+            for entry in reversed(serialized):
+                file_handle.write(_json_dumps(entry) + "\n")
+    except Exception:
+        return
+    st.session_state["_history_log_lines"] = len(serialized)
     history_path = _get_history_path(session_id)
-    payload = {
-        "updated_at": datetime.datetime.utcnow().isoformat(),
-        "history": _serialize_history(st.session_state.history),
-    }
     try:
-        with open(history_path, "w", encoding="utf-8") as file_handle:
-            json.dump(payload, file_handle)
+        if os.path.exists(history_path):
+            os.remove(history_path)
     except Exception:
         return
 
 
-def clear_history_storage() -> None:
-    session_id = get_browser_session_id(create=False)
+def append_history_entry(entry: Dict[str, object]) -> None:
+    log_lines = st.session_state.get("_history_log_lines", 0)
+    if log_lines is None or log_lines >= HISTORY_LOG_COMPACT_LINES:
+        persist_history_to_storage()
+        return
+    session_id = get_browser_session_id(create=True)
     if not session_id:
         return
-    history_path = _get_history_path(session_id)
+    line = _json_dumps(_serialize_history([entry])[0])
     try:
-        if os.path.exists(history_path):
-            os.remove(history_path)
+        with open(_get_history_log_path(session_id), "a", encoding="utf-8") as file_handle:
+            file_handle.write(line + "\n")
     except Exception:
         return
+    st.session_state["_history_log_lines"] = log_lines + 1
+
+
+def clear_history_storage() -> None:
+    for entry in st.session_state.get("history", ()):
+        remove_history_image(entry)
+    st.session_state.pop("_history_log_lines", None)
+    session_id = get_browser_session_id(create=False)
+    if not session_id:
+        return
+    for history_path in (_get_history_path(session_id), _get_history_log_path(session_id)):
+        try:
+            if os.path.exists(history_path):
+                os.remove(history_path)
+        except Exception:
+            continue
+
+
+def new_history(entries: Sequence[Dict[str, object]] = ()) -> "collections.deque[Dict[str, object]]":
+    return collections.deque(entries, maxlen=HISTORY_MAX_ENTRIES)
 
 
 def logout() -> None:
     st.session_state["authenticated"] = False
+    st.session_state.pop("_auth_hash_cache", None)
     persist_login_to_cookie(False)
     clear_history_storage()
-    st.session_state.history = []
+    st.session_state.history = new_history()
     rerun_app()
 
 
@@ -395,8 +613,8 @@ def require_login() -> None:
 
     st.title("ログイン")
 
-    username, password = get_configured_auth_credentials()
-    if not username or not password:
+    expected_hashes = get_expected_credential_hashes()
+    if expected_hashes is None:
         st.info("ログイン情報が未設定です。管理者に連絡してください。")
         st.stop()
         return
@@ -409,7 +627,10 @@ def require_login() -> None:
     inject_login_autofill_js()
 
     if submitted:
-        if input_username == username and input_password == password:
+        hash_key, expected_username, expected_password = expected_hashes
+        username_ok = _credentials_match(input_username, hash_key, expected_username)
+        password_ok = _credentials_match(input_password, hash_key, expected_password)
+        if username_ok and password_ok:
             st.session_state["authenticated"] = True
             persist_login_to_cookie(True)
             get_browser_session_id(create=True)
@@ -420,36 +641,243 @@ def require_login() -> None:
     st.stop()
 
 
+@st.cache_resource(show_spinner=False)
+def _default_api_key() -> str:
+    return (
+        get_secret_value("GEMINI_API_KEY")
+        or os.getenv("GOOGLE_API_KEY")
+        or os.getenv("GEMINI_API_KEY")
+        or ""
+    )
+
+
 def get_current_api_key() -> Optional[str]:
     api_key = st.session_state.get("config_api_key")
     if isinstance(api_key, str) and api_key.strip():
         return api_key.strip()
-    return DEFAULT_GEMINI_API_KEY
+    return _default_api_key()
 
 
 def load_configured_api_key() -> str:
     return get_current_api_key() or ""
 
 
-def decode_image_data(data: Optional[object]) -> Optional[bytes]:
-    if data is None:
+def get_gemini_rpm() -> Optional[int]:
+    raw_rpm = get_secret_value("GEMINI_RPM")
+    if not raw_rpm:
         return None
+    try:
+        return max(1, int(raw_rpm))
+    except (TypeError, ValueError):
+        return None
+
+
+def assemble_prompt(stripped_prompt: str) -> str:
+    if stripped_prompt:
+        return f"{stripped_prompt}\n{PROMPT_WITH_NOTEXT_SUFFIX}"
+    return PROMPT_WITH_NOTEXT_SUFFIX
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _create_client(api_key_digest: str, _api_key: str) -> "genai.Client":
+    from google import genai
+    from google.genai import types
+
+    return genai.Client(
+        api_key=_api_key,
+        http_options=types.HttpOptions(
+            timeout=GENERATE_TIMEOUT_SECONDS * 1000,
+            retry_options=types.HttpRetryOptions(attempts=GENERATE_RETRY_ATTEMPTS),
+        ),
+    )
+
+
+def get_api_key_digest(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def get_client(api_key: str) -> "genai.Client":
+    return _create_client(get_api_key_digest(api_key), api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="gemini-event-loop", daemon=True).start()
+    return loop
+
+
+@st.cache_resource(show_spinner=False)
+def get_worker_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="nanobanana-worker")
+
+
+T = TypeVar("T")
+
+
+def submit_with_script_context(func: Callable[..., T], *args: Any, **kwargs: Any) -> "Future[T]":
+    script_ctx = get_script_run_ctx() if get_script_run_ctx else None
+
+    def run() -> T:
+        if script_ctx is not None and add_script_run_ctx is not None:
+            add_script_run_ctx(threading.current_thread(), script_ctx)
+        return func(*args, **kwargs)
+
+    return get_worker_pool().submit(run)
+
+
+@st.cache_resource(show_spinner=False)
+def get_generate_config() -> "types.GenerateContentConfig":
+    from google.genai import types
+
+    return types.GenerateContentConfig(
+        response_modalities=["TEXT", "IMAGE"],
+        image_config=types.ImageConfig(aspect_ratio=IMAGE_ASPECT_RATIO),
+    )
+
+
+async def _stream_image_async(client: "genai.Client", contents: str) -> Tuple[Optional[bytes], List[str]]:
+    stream_method = getattr(client.aio.models, "generate_content_stream", None)
+    if stream_method is None:
+        response = await client.aio.models.generate_content(
+            model=MODEL_NAME,
+            contents=contents,
+            config=get_generate_config(),
+        )
+        return extract_payload(response)
+    image_bytes: Optional[bytes] = None
+    texts: List[str] = []
+    stream = await stream_method(model=MODEL_NAME, contents=contents, config=get_generate_config())
+    try:
+        async for chunk in stream:
+            for kind, payload in iter_parts(chunk):
+                if kind == "text":
+                    texts.append(payload)
+                else:
+                    image_bytes = payload
+                    break
+            if image_bytes is not None:
+                break
+    finally:
+        close = getattr(stream, "aclose", None)
+        if callable(close):
+            await close()
+    return image_bytes, texts
+
+
+class GenerationRateLimited(Exception):
+    pass
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def get_request_log(api_key_digest: str) -> "collections.deque[float]":
+    return collections.deque()
+
+
+async def _acquire_request_slot(request_log: "collections.deque[float]", rpm: int, deadline: float) -> None:
+    while True:
+        now = time.monotonic()
+        while request_log and now - request_log[0] >= 60:
+            request_log.popleft()
+        if len(request_log) < rpm:
+            request_log.append(now)
+            return
+        wait_seconds = 60 - (now - request_log[0])
+        if now + wait_seconds > deadline:
+            raise GenerationRateLimited()
+        await asyncio.sleep(wait_seconds)
+
+
+async def _generate_within_rate_limit(
+    client: "genai.Client",
+    contents: str,
+    request_log: Optional["collections.deque[float]"],
+    rpm: Optional[int],
+) -> Tuple[Optional[bytes], List[str]]:
+    if request_log is not None and rpm is not None:
+        await _acquire_request_slot(request_log, rpm, time.monotonic() + RATE_LIMIT_WAIT_SECONDS)
+    return await asyncio.wait_for(
+        _stream_image_async(client, contents),
+        timeout=GENERATE_TIMEOUT_SECONDS * GENERATE_RETRY_ATTEMPTS,
+    )
+
+
+def submit_generation(
+    client: "genai.Client",
+    contents: str,
+    request_log: Optional["collections.deque[float]"] = None,
+    rpm: Optional[int] = None,
+) -> Future:
+    return asyncio.run_coroutine_threadsafe(
+        _generate_within_rate_limit(client, contents, request_log, rpm),
+        get_event_loop(),
+    )
+
+
+def split_prompts(text: str) -> List[str]:
+    prompts: List[str] = []
+    block: List[str] = []
+    for line in text.splitlines():
+        if line.strip():
+            block.append(line)
+        elif block:
+            prompts.append("\n".join(block).strip())
+            block = []
+    if block:
+        prompts.append("\n".join(block).strip())
+    return prompts
+
+
+def show_generation_error(exc: BaseException) -> None:
+    import httpx
+    from google.api_core import exceptions as google_exceptions
+
+    if isinstance(exc, GenerationRateLimited):
+        st.error(
+            "1分あたりのリクエスト数の上限（GEMINI_RPM）に達しました。"
+            "しばらく待ってからもう一度 Generate を押してください。"
+        )
+    elif isinstance(exc, (asyncio.TimeoutError, google_exceptions.DeadlineExceeded, httpx.TimeoutException)):
+        st.error(
+            "Gemini API の応答がタイムアウトしました。"
+            "時間をおいてもう一度 Generate を押してください。"
+        )
+    elif isinstance(exc, google_exceptions.ResourceExhausted):
+        st.error(
+            "Gemini API のクォータ（無料枠または請求プラン）を超えました。"
+            "しばらく待つか、Google AI Studio で利用状況と請求設定を確認してください。"
+        )
+        st.info("https://ai.google.dev/gemini-api/docs/rate-limits")
+    elif isinstance(exc, google_exceptions.GoogleAPICallError):
+        st.error(f"API 呼び出しに失敗しました: {exc.message}")
+    else:
+        st.error(f"予期しないエラーが発生しました: {exc}")
+
+
+def decode_image_data(data: Optional[object]) -> Optional[bytes]:
     if isinstance(data, bytes):
         return data
+    if isinstance(data, (bytearray, memoryview)):
+        return bytes(data)
     if isinstance(data, str):
         try:
-            return base64.b64decode(data)
+            return b64_codec.b64decode(data, validate=False)
         except (ValueError, TypeError):
             return None
     return None
 
 
+_get_candidate_parts = operator.attrgetter("content.parts")
+
+
 def extract_parts(candidate: object) -> Sequence:
-    content = getattr(candidate, "content", None)
-    parts = getattr(content, "parts", None) if content is not None else None
-    if parts is None and isinstance(candidate, dict):
-        parts = candidate.get("content", {}).get("parts", [])
-    return parts or []
+    try:
+        return _get_candidate_parts(candidate) or []
+    except AttributeError:
+        pass
+    if isinstance(candidate, dict):
+        return (candidate.get("content") or {}).get("parts") or []
+    return []
 
 
 def collect_image_bytes(response: object) -> Optional[bytes]:
@@ -561,17 +989,48 @@ def collect_image_bytes(response: object) -> Optional[bytes]:
     return None
 
 
-def collect_text_parts(response: object) -> List[str]:
-    texts: List[str] = []
+def _read_attr_part(part: object) -> Tuple[object, Optional[str]]:
+    try:
+        data = part.inline_data.data
+    except AttributeError:
+        data = None
+    return data, getattr(part, "text", None)
+
+
+def _read_dict_part(part: Dict[str, Any]) -> Tuple[object, Optional[str]]:
+    inline = part.get("inline_data")
+    data = inline.get("data") if isinstance(inline, dict) else getattr(inline, "data", None)
+    return data, part.get("text")
+
+
+def iter_parts(response: object) -> Iterator[Tuple[str, object]]:
     candidates = getattr(response, "candidates", None) or []
     for candidate in candidates:
-        for part in extract_parts(candidate):
-            text = getattr(part, "text", None)
-            if text is None and isinstance(part, dict):
-                text = part.get("text")
+        parts = extract_parts(candidate)
+        if not parts:
+            continue
+        read_part = _read_dict_part if isinstance(parts[0], dict) else _read_attr_part
+        for part in parts:
+            data, text = read_part(part)
+            if data is not None:
+                decoded = decode_image_data(data)
+                if decoded:
+                    yield "image", decoded
             if text:
-                texts.append(text)
-    return texts
+                yield "text", text
+
+
+def extract_payload(response: object) -> Tuple[Optional[bytes], List[str]]:
+    image_bytes: Optional[bytes] = None
+    texts: List[str] = []
+    for kind, payload in iter_parts(response):
+        if kind == "text":
+            texts.append(payload)
+        elif image_bytes is None:
+            image_bytes = payload
+    if image_bytes is None:
+        image_bytes = collect_image_bytes(response)
+    return image_bytes, texts
 
 
 def _get_from_container(container: object, key: str) -> Optional[Any]:
@@ -680,6 +1139,12 @@ def upload_image_to_gcs(
         st.error("service_account_json の内容が辞書形式ではありません。")
         return None, None
 
+    try:
+        from google.cloud import storage
+    except ImportError:
+        st.error("google-cloud-storage がインストールされていないためアップロードをスキップしました。")
+        return None, None
+
     try:
         storage_client = storage.Client.from_service_account_info(
             service_account_info,
@@ -712,11 +1177,11 @@ def upload_image_to_gcs(
 
 def init_history() -> None:
     if "history" not in st.session_state:
-        st.session_state.history = []
+        st.session_state.history = new_history()
     if not st.session_state.get("_history_loaded"):
         restored = load_history_from_storage()
         if restored is not None:
-            st.session_state.history = restored
+            st.session_state.history = new_history(restored)
             st.session_state["_history_loaded"] = True
         else:
             if get_browser_session_id(create=False) is not None or _get_cookie_controller() is None:
@@ -724,6 +1189,8 @@ def init_history() -> None:
 
 
 def ensure_lightbox_assets() -> None:
+    if st.session_state.get("_lightbox_installed"):
+        return
     components.html(
         """
         <script>
@@ -745,16 +1212,13 @@ def ensure_lightbox_assets() -> None:
                 const style = doc.createElement("style");
                 style.id = "streamlit-lightbox-style";
                 style.textContent = `
-                .streamlit-lightbox-thumb {
-                    width: 100%;
-                    display: block;
+                .st-key-history [data-testid="stImage"] img {
                     border-radius: 12px;
                     cursor: pointer;
                     transition: transform 0.16s ease-in-out;
                     box-shadow: 0 4px 14px rgba(0, 0, 0, 0.12);
-                    margin: 0 auto 0.75rem auto;
                 }
-                .streamlit-lightbox-thumb:hover {
+                .st-key-history [data-testid="stImage"] img:hover {
                     transform: scale(1.02);
                 }
                 `;
@@ -772,7 +1236,7 @@ def ensure_lightbox_assets() -> None:
                     overlay.style.opacity = "0";
                     const originalOverflow = overlay.getAttribute("data-original-overflow") || "";
                     doc.body.style.overflow = originalOverflow;
-                    setTimeout(function () {
+                    parentWindow.setTimeout(function () {
                         if (overlay && overlay.parentNode) {
                             overlay.parentNode.removeChild(overlay);
                         }
@@ -824,91 +1288,40 @@ def ensure_lightbox_assets() -> None:
                     parentWindow.addEventListener("keydown", keyHandler);
 
                     doc.body.appendChild(overlay);
-                    requestAnimationFrame(function () {
+                    parentWindow.requestAnimationFrame(function () {
                         overlay.style.opacity = "1";
                     });
                 }
 
                 return { show, hide };
             })();
+
+            if (!parentWindow.__streamlitLightboxClickHandler) {
+                parentWindow.__streamlitLightboxClickHandler = function (event) {
+                    const target = event.target;
+                    if (!target || target.tagName !== "IMG" || !target.closest) {
+                        return;
+                    }
+                    if (!target.closest('.st-key-history [data-testid="stImage"]')) {
+                        return;
+                    }
+                    const row = target.closest('[class*="st-key-history_row_"]');
+                    const full = row && row.querySelector('[data-testid="stExpander"] [data-testid="stImage"] img');
+                    if (parentWindow.__streamlitLightbox) {
+                        parentWindow.__streamlitLightbox.show(
+                            (full && full.getAttribute("src")) || target.getAttribute("src")
+                        );
+                    }
+                };
+                doc.addEventListener("click", parentWindow.__streamlitLightboxClickHandler);
+            }
         })();
         </script>
         """,
         height=0,
         scrolling=False,
     )
-
-
-def render_clickable_image(image_bytes: bytes, element_id: str) -> None:
-    ensure_lightbox_assets()
-    encoded = base64.b64encode(image_bytes).decode("utf-8")
-    image_src = f"data:image/png;base64,{encoded}"
-    image_src_json = json.dumps(image_src)
-    components.html(
-        f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="utf-8">
-    <style>
-        body {{
-            margin: 0;
-            padding: 0;
-            background: transparent;
-        }}
-        img {{
-            width: 100%;
-            display: block;
-            border-radius: 12px;
-            cursor: pointer;
-            transition: transform 0.16s ease-in-out;
-            box-shadow: 0 4px 14px rgba(0, 0, 0, 0.12);
-        }}
-        img:hover {{
-            transform: scale(1.02);
-        }}
-    </style>
-</head>
-<body>
-    <img id="thumb" src="{image_src}" alt="Generated image">
-    <script>
-    (function() {{
-        const img = document.getElementById("thumb");
-        if (!img) {{
-            return;
-        }}
-
-        function resizeFrame() {{
-            const frame = window.frameElement;
-            if (!frame) {{
-                return;
-            }}
-            const frameWidth = frame.getBoundingClientRect().width || img.naturalWidth || img.clientWidth || 0;
-            const ratio = img.naturalWidth ? (img.naturalHeight / Math.max(img.naturalWidth, 1)) : (img.clientHeight / Math.max(img.clientWidth, 1) || 1);
-            const height = frameWidth ? Math.max(160, frameWidth * ratio) : (img.clientHeight || img.naturalHeight || 320);
-            frame.style.height = height + "px";
-        }}
-
-        if (img.complete) {{
-            resizeFrame();
-        }} else {{
-            img.addEventListener("load", resizeFrame);
-        }}
-        window.addEventListener("resize", resizeFrame);
-        setTimeout(resizeFrame, 60);
-
-        img.addEventListener("click", function() {{
-            if (window.parent && window.parent.__streamlitLightbox) {{
-                window.parent.__streamlitLightbox.show({image_src_json});
-            }}
-        }});
-    }})();
-    </script>
-</body>
-</html>
-""",
-        height=400,
-        scrolling=False,
-    )
+    st.session_state["_lightbox_installed"] = True
 
 
 def render_history() -> None:
@@ -916,15 +1329,38 @@ def render_history() -> None:
         return
 
     st.subheader("履歴")
-    for entry in st.session_state.history:
-        image_bytes = entry.get("image_bytes")
-        prompt_text = entry.get("prompt") or ""
-        if image_bytes:
-            image_id = entry.get("id")
-            if not isinstance(image_id, str):
-                image_id = f"img_{uuid.uuid4().hex}"
-                entry["id"] = image_id
-            render_clickable_image(image_bytes, image_id)
+    ensure_lightbox_assets()
+    with st.container(key="history"):
+        for entry in st.session_state.history:
+            render_history_entry(entry)
+
+
+def render_history_entry(entry: Dict[str, object]) -> None:
+    image_id = entry.get("id")
+    if not isinstance(image_id, str):
+        image_id = f"img_{uuid.uuid4().hex}"
+        entry["id"] = image_id
+    image_path = entry.get("image_path")
+    prompt_text = entry.get("prompt") or ""
+    with st.container(key=f"history_row_{image_id}"):
+        if image_path:
+            image_bytes = read_history_image(image_path) or b""
+            thumbnail_path = entry.get("thumbnail_path")
+            if thumbnail_path:
+                st.image(thumbnail_path, width="stretch", output_format="JPEG")
+            elif image_bytes:
+                st.image(image_bytes, width="stretch", output_format="PNG")
+            with st.expander("原寸表示"):
+                if image_bytes:
+                    st.image(image_bytes, width="stretch", output_format="PNG")
+                st.download_button(
+                    "ダウンロード",
+                    data=image_bytes,
+                    file_name=os.path.basename(image_path),
+                    mime="image/png",
+                    key=f"download_{image_id}",
+                    on_click="ignore",
+                )
         prompt_display = prompt_text.strip()
         st.markdown("**Prompt**")
         if prompt_display:
@@ -934,21 +1370,42 @@ def render_history() -> None:
         st.divider()
 
 
-def main() -> None:
-    st.set_page_config(page_title=TITLE, page_icon="🧠", layout="centered")
-    sync_cookie_controller()
-    init_history()
-    require_login()
+def save_generated_image(user_prompt: str, image_bytes: bytes) -> bool:
+    object_name = build_prompt_based_filename(user_prompt)
+    upload_future = submit_with_script_context(upload_image_to_gcs, image_bytes, object_name=object_name)
 
-    with st.sidebar:
-        if st.button("ログアウト"):
-            logout()
+    image_id = f"img_{uuid.uuid4().hex}"
+    image_path, thumbnail_path = store_history_images(image_id, image_bytes)
+    upload_error = upload_future.exception()
+    if upload_error is not None:
+        st.error(f"GCSへのアップロード中にエラーが発生しました: {upload_error}")
+    if not image_path:
+        st.error("画像を履歴に保存できませんでした。")
+        return False
+
+    history = st.session_state.history
+    if len(history) == history.maxlen:
+        remove_history_image(history[-1])
+    entry = {
+        "id": image_id,
+        "image_path": image_path,
+        "thumbnail_path": thumbnail_path,
+        "prompt": user_prompt,
+        "model": MODEL_NAME,
+        "no_text": True,
+    }
+    history.appendleft(entry)
+    append_history_entry(entry)
+    return True
 
-    st.title("脳内大喜利")
 
+@st.fragment
+def render_generator() -> None:
     api_key = load_configured_api_key()
 
     prompt = st.text_area("Prompt", height=150, placeholder="描いてほしい内容を入力してください")
+    multi_prompt = st.toggle("空行で区切った複数のプロンプトをまとめて生成する")
+    variations = st.slider("バリエーション数", min_value=1, max_value=MAX_VARIATIONS, value=1)
     if st.button("Generate", type="primary"):
         if not api_key:
             st.warning("Gemini API key が設定されていません。Streamlit secrets などで設定してください。")
@@ -956,62 +1413,67 @@ def main() -> None:
         if not prompt.strip():
             st.warning("プロンプトを入力してください。")
             st.stop()
-
-        client = genai.Client(api_key=api_key.strip())
-        stripped_prompt = prompt.rstrip()
-        prompt_components: List[str] = []
-        if stripped_prompt:
-            prompt_components.append(stripped_prompt)
-        prompt_components.extend([DEFAULT_PROMPT_SUFFIX, NO_TEXT_TOGGLE_SUFFIX])
-        prompt_for_request = "\n".join(prompt_components)
-
+        require_generation_libraries()
+
+        api_key = api_key.strip()
+        client = get_client(api_key)
+        user_prompts = split_prompts(prompt) if multi_prompt else [prompt.strip()]
+        max_prompts = HISTORY_MAX_ENTRIES // variations
+        if len(user_prompts) > max_prompts:
+            st.warning(
+                f"一度に生成できるのは {HISTORY_MAX_ENTRIES} 枚までです。"
+                f"先頭の {max_prompts} 件のプロンプトのみ生成します。"
+            )
+            user_prompts = user_prompts[:max_prompts]
+        rpm = get_gemini_rpm()
+        request_log = get_request_log(get_api_key_digest(api_key)) if rpm else None
+
+        completed = 0
         with st.spinner("画像を生成しています..."):
+            futures = {
+                submit_generation(client, assemble_prompt(user_prompt), request_log, rpm): user_prompt
+                for user_prompt in user_prompts
+                for _ in range(variations)
+            }
             try:
-                response = client.models.generate_content(
-                    model=MODEL_NAME,
-                    contents=prompt_for_request,
-                    config=types.GenerateContentConfig(
-                        response_modalities=["TEXT", "IMAGE"],
-                        image_config=types.ImageConfig(aspect_ratio=IMAGE_ASPECT_RATIO),
-                    ),
-                )
-            except google_exceptions.ResourceExhausted:
-                st.error(
-                    "Gemini API のクォータ（無料枠または請求プラン）を超えました。"
-                    "しばらく待つか、Google AI Studio で利用状況と請求設定を確認してください。"
-                )
-                st.info("https://ai.google.dev/gemini-api/docs/rate-limits")
-                st.stop()
-            except google_exceptions.GoogleAPICallError as exc:
-                st.error(f"API 呼び出しに失敗しました: {exc.message}")
-                st.stop()
-            except Exception as exc:  # noqa: BLE001
-                st.error(f"予期しないエラーが発生しました: {exc}")
-                st.stop()
-
-        image_bytes = collect_image_bytes(response)
-        if not image_bytes:
-            st.error("画像データを取得できませんでした。")
+                for future in as_completed(futures):
+                    try:
+                        image_bytes, _texts = future.result()
+                    except Exception as exc:  # noqa: BLE001
+                        show_generation_error(exc)
+                        continue
+                    if not image_bytes:
+                        st.error("画像データを取得できませんでした。")
+                        continue
+                    if save_generated_image(futures[future], image_bytes):
+                        completed += 1
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        if not completed:
             st.stop()
+        if len(futures) == 1:
+            st.success("生成完了")
+        else:
+            st.success(f"生成完了（{completed}/{len(futures)} 件）")
 
-        user_prompt = prompt.strip()
-        object_name = build_prompt_based_filename(user_prompt)
-        upload_image_to_gcs(image_bytes, object_name=object_name)
+    render_history()
 
-        st.session_state.history.insert(
-            0,
-            {
-                "id": f"img_{uuid.uuid4().hex}",
-                "image_bytes": image_bytes,
-                "prompt": user_prompt,
-                "model": MODEL_NAME,
-                "no_text": True,
-            },
-        )
-        persist_history_to_storage()
-        st.success("生成完了")
 
-    render_history()
+def main() -> None:
+    st.set_page_config(page_title=TITLE, page_icon="🧠", layout="centered")
+    sync_cookie_controller()
+    init_history()
+    require_login()
+
+    with st.sidebar:
+        if st.button("ログアウト"):
+            logout()
+
+    st.title("脳内大喜利")
+
+    render_generator()
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 import base64
 import datetime
+import functools
+import hmac
 import json
 import os
 import tempfile
@@ -14,23 +16,30 @@ try:
 except ImportError:
     CookieController = None
 
+try:
+    import pybase64 as b64_codec
+except ImportError:
+    b64_codec = base64
+
 try:
     from streamlit.runtime.secrets import StreamlitSecretNotFoundError
 except ImportError:
     StreamlitSecretNotFoundError = Exception
 
 
-def get_secret_value(key: str) -> Optional[str]:
-    try:
-        secrets_obj = st.secrets
-    except StreamlitSecretNotFoundError:
-        return None
-    except Exception:
+@functools.lru_cache(maxsize=32)
+def _read_secret(key: str) -> Optional[str]:
+    secrets_obj = getattr(st, "secrets", None)
+    if secrets_obj is None:
         return None
     try:
+        if key not in secrets_obj:
+            return None
         return secrets_obj[key]
-    except (KeyError, TypeError, StreamlitSecretNotFoundError):
+    except TypeError:
         pass
+    except Exception:
+        return None
     get_method = getattr(secrets_obj, "get", None)
     if callable(get_method):
         try:
@@ -40,6 +49,10 @@ def get_secret_value(key: str) -> Optional[str]:
     return None
 
 
+def get_secret_value(key: str) -> Optional[str]:
+    return _read_secret(key)
+
+
 def rerun_app() -> None:
     rerun = getattr(st, "rerun", None)
     if callable(rerun):
@@ -58,6 +71,10 @@ def _normalize_credential(value: Optional[str]) -> Optional[str]:
     return None
 
 
+def _credentials_match(value: Optional[str], expected: str) -> bool:
+    return hmac.compare_digest((value or "").encode("utf-8"), expected.encode("utf-8"))
+
+
 def get_secret_auth_credentials() -> Tuple[Optional[str], Optional[str]]:
     try:
         secrets_obj = st.secrets
@@ -229,7 +246,9 @@ def require_basic_login(
         submitted = st.form_submit_button("ログイン")
 
     if submitted:
-        if input_username == username and input_password == password:
+        username_ok = _credentials_match(input_username, username)
+        password_ok = _credentials_match(input_password, password)
+        if username_ok and password_ok:
             st.session_state[session_state_key] = True
             persist_login_to_cookie(True, cookie_key=cookie_key)
             st.success(success_message)
@@ -283,7 +302,7 @@ def _serialize_history(history: List[Dict[str, object]]) -> List[Dict[str, objec
     for entry in history:
         image_bytes = entry.get("image_bytes")
         if isinstance(image_bytes, (bytes, bytearray, memoryview)):
-            image_b64 = base64.b64encode(bytes(image_bytes)).decode("utf-8")
+            image_b64 = b64_codec.b64encode(bytes(image_bytes)).decode("utf-8")
         else:
             image_b64 = None
         serialized.append(
@@ -397,13 +416,13 @@ def init_history(
 
 
 def decode_image_data(data: Optional[object]) -> Optional[bytes]:
-    if data is None:
-        return None
     if isinstance(data, bytes):
         return data
+    if isinstance(data, (bytearray, memoryview)):
+        return bytes(data)
     if isinstance(data, str):
         try:
-            return base64.b64decode(data)
+            return b64_codec.b64decode(data, validate=False)
         except (ValueError, TypeError):
             return None
     return None